@@ -2,7 +2,8 @@ import os
 import logging
 from datetime import datetime, timezone
 from typing import List, Dict, Optional, Any
-from notion_client import Client
+import httpx
+from notion_client import Client, AsyncClient
 
 class NotionIntegration:
     def __init__(self, token: str, database_id: str):
@@ -14,6 +15,13 @@ class NotionIntegration:
             database_id: ID базы данных Notion
         """
         self.client = Client(auth=token)
+        # Асинхронный клиент для вызовов из event loop: собственный пул keep-alive соединений с HTTP/2.
+        # SDK перезаписывает base_url и Authorization httpx клиента, поэтому пул ни с кем не делится
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+        )
+        self.aclient = AsyncClient(auth=token, timeout_ms=10_000, client=http_client)
         self.database_id = database_id
         self.logger = logging.getLogger(__name__)
         
@@ -157,8 +165,13 @@ class NotionIntegration:
             rich_text = block.get(block_type, {}).get('rich_text', [])
             return ''.join([item.get('plain_text', '') for item in rich_text])
         
-        return '' 
-    def get_page_data(self, page_id: str) -> Optional[Dict]:
+        return ''
+    
+    async def aclose(self) -> None:
+        """Закрытие пула соединений асинхронного клиента"""
+        await self.aclient.aclose()
+    
+    async def get_page_data(self, page_id: str) -> Optional[Dict]:
         """
         Получение данных страницы по ID
         
@@ -170,7 +183,7 @@ class NotionIntegration:
         """
         try:
             # Получаем данные страницы
-            page = self.client.pages.retrieve(page_id=page_id)
+            page = await self.aclient.pages.retrieve(page_id=page_id)
             
             # Парсим страницу
             parsed_page = self._parse_page(page)
@@ -283,7 +296,8 @@ class NotionIntegration:
             self.logger.error(f"Ошибка при добавлении содержимого: {e}")
             return False
     
-    def update_page_property(self, page_id: str, property_name: str, property_value: Any) -> bool:
+    async def update_page_property(self, page_id: str, property_name: str, property_value: Any,
+                                   prop_type: str = None) -> bool:
         """
         Обновление свойства страницы в Notion
         
@@ -291,21 +305,22 @@ class NotionIntegration:
             page_id: ID страницы
             property_name: Название свойства
             property_value: Значение свойства (тип зависит от свойства)
+            prop_type: Тип свойства, если уже известен (иначе страница запрашивается из Notion)
             
         Returns:
             True если успешно
         """
         try:
             # Определяем тип свойства и форматируем значение
-            page = self.client.pages.retrieve(page_id=page_id)
-            properties = page.get('properties', {})
-            
-            if property_name not in properties:
-                self.logger.error(f"Свойство '{property_name}' не найдено на странице")
-                return False
-            
-            prop_info = properties[property_name]
-            prop_type = prop_info.get('type')
+            if prop_type is None:
+                page = await self.aclient.pages.retrieve(page_id=page_id)
+                properties = page.get('properties', {})
+                
+                if property_name not in properties:
+                    self.logger.error(f"Свойство '{property_name}' не найдено на странице")
+                    return False
+                
+                prop_type = properties[property_name].get('type')
             
             # Формируем обновление в зависимости от типа свойства
             update_data = {}
@@ -359,7 +374,7 @@ class NotionIntegration:
                 return False
             
             # Обновляем страницу
-            self.client.pages.update(
+            await self.aclient.pages.update(
                 page_id=page_id,
                 properties=update_data
             )
@@ -370,49 +385,3 @@ class NotionIntegration:
         except Exception as e:
             self.logger.error(f"Ошибка при обновлении свойства: {e}")
             return False
-    
-    def get_page_status_options(self, page_id: str, status_property_name: str = None) -> List[str]:
-        """
-        Получение доступных опций статуса для страницы
-        
-        Args:
-            page_id: ID страницы
-            status_property_name: Название свойства статуса (если None, ищет автоматически)
-            
-        Returns:
-            Список доступных статусов
-        """
-        try:
-            page = self.client.pages.retrieve(page_id=page_id)
-            properties = page.get('properties', {})
-            
-            # Если название свойства не указано, ищем свойство типа 'status'
-            if not status_property_name:
-                for prop_name, prop_data in properties.items():
-                    if prop_data.get('type') == 'status':
-                        status_property_name = prop_name
-                        break
-            
-            if not status_property_name or status_property_name not in properties:
-                self.logger.warning("Свойство статуса не найдено")
-                return []
-            
-            prop_info = properties[status_property_name]
-            
-            # Получаем опции статуса из базы данных
-            if prop_info.get('type') == 'status':
-                # Для status нужно получить опции из базы данных
-                parent_db = page.get('parent', {})
-                if parent_db.get('type') == 'database_id':
-                    database_id = parent_db.get('database_id')
-                    db_info = self.client.databases.retrieve(database_id=database_id)
-                    db_props = db_info.get('properties', {})
-                    if status_property_name in db_props:
-                        status_options = db_props[status_property_name].get('status', {}).get('options', [])
-                        return [option.get('name') for option in status_options]
-            
-            return []
-            
-        except Exception as e:
-            self.logger.error(f"Ошибка при получении опций статуса: {e}")
-            return []
\ No newline at end of file
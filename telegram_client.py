@@ -6,15 +6,16 @@ from telegram.constants import ParseMode
 from telegram.error import TelegramError
 
 class TelegramIntegration:
-    def __init__(self, bot_token: str, channel_id: str):
+    def __init__(self, bot_token: str, channel_id: str, bot: Optional[Bot] = None):
         """
         Инициализация Telegram Bot
         
         Args:
             bot_token: Токен Telegram бота
             channel_id: ID канала или username (@channel_name)
+            bot: Уже созданный Bot (например, Application.bot), чтобы использовать его пул соединений
         """
-        self.bot = Bot(token=bot_token)
+        self.bot = bot or Bot(token=bot_token)
         self.channel_id = channel_id
         self.logger = logging.getLogger(__name__)
         
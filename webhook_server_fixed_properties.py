@@ -6,44 +6,70 @@ Notion Webhook Server - Полное извлечение ВСЕХ данных
 
 import os
 import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import hmac
 import hashlib
-import json
+import html
 import re
-from datetime import datetime
-from typing import Dict, Any, List
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+from cachetools import TTLCache
+import orjson
+try:
+    import ciso8601
+except ImportError:  # необязательная зависимость: без нее используется datetime.fromisoformat
+    ciso8601 = None
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse, Response
 import uvicorn
 from dotenv import load_dotenv
 
 from notion_integration import NotionIntegration
 from telegram_client import TelegramIntegration
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 
 # Загрузка переменных окружения
 load_dotenv()
 
-# Настройка логирования
+# Настройка логирования: запись в файл и консоль идет в отдельном потоке
+# QueueListener, чтобы дисковый ввод-вывод не блокировал event loop
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.FileHandler('webhook_server.log'),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('webhook_server.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_listener.start()
+# Поток записи живет столько же, сколько процесс: останавливается при выходе, а не в shutdown_event,
+# который может выполняться несколько раз (повторный lifespan приложения)
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Notion-Telegram Webhook", version="1.0.0")
+def _dbg(msg: str, *args):
+    """Отладочная запись: аргументы форматируются, только если DEBUG включен"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg, *args)
+
+app = FastAPI(title="Notion-Telegram Webhook", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Middleware для логирования всех запросов
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     """Логирование всех входящих запросов"""
-    start_time = datetime.now()
+    start_time = time.perf_counter()
     path = request.url.path
     headers = dict(request.headers)
     
@@ -63,7 +89,7 @@ async def log_requests(request: Request, call_next):
         # Блокируем подозрительные запросы без логирования
         client_ip = request.client.host if request.client else "unknown"
         logger.warning(f"🚫 Блокирован подозрительный запрос от {client_ip}: {request.method} {path}")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=404,
             content={"status": "not found"}
         )
@@ -77,27 +103,16 @@ async def log_requests(request: Request, call_next):
     
     # Логируем только разрешенные пути или POST на корневой путь (для Notion webhook)
     if path in allowed_paths or (path == '/' and request.method == 'POST'):
-        # Особое логирование для Telegram webhook
-        if path == "/telegram/webhook":
-            logger.info(f"🌐 ===== TELEGRAM WEBHOOK REQUEST =====")
-            logger.info(f"🌐 Method: {request.method}")
-            logger.info(f"🌐 Path: {path}")
-            logger.info(f"🌐 Query: {request.url.query}")
-            logger.info(f"🌐 Headers: {headers}")
-            logger.info(f"🌐 Content-Type: {headers.get('content-type', 'N/A')}")
-            logger.info(f"🌐 Content-Length: {headers.get('content-length', 'N/A')}")
-        else:
-            logger.info(f"Входящий запрос: {request.method} {path}?{request.url.query}")
+        logger.info(f"Входящий запрос: {request.method} {path}?{request.url.query}")
+        _dbg("Заголовки запроса %s: %s", path, headers)
     else:
         # Для неизвестных путей - минимальное логирование
         logger.debug(f"Запрос на неизвестный путь: {request.method} {path}")
     
     try:
         response = await call_next(request)
-        process_time = (datetime.now() - start_time).total_seconds()
-        if path == "/telegram/webhook":
-            logger.info(f"🌐 Ответ: {response.status_code} за {process_time:.3f}с")
-        elif path in allowed_paths:
+        process_time = time.perf_counter() - start_time
+        if path in allowed_paths:
             logger.info(f"Ответ: {response.status_code} за {process_time:.3f}с")
         return response
     except Exception as e:
@@ -105,33 +120,221 @@ async def log_requests(request: Request, call_next):
         raise
 
 # Инициализация клиентов
-notion_client = None
-telegram_client = None
-telegram_app = None  # Для обработки сообщений из Telegram
+# Клиенты создаются в startup_event и хранятся в app.state
+app.state.notion = None
+app.state.telegram = None
+app.state.telegram_app = None  # Для обработки сообщений из Telegram
+app.state.webhook_processor = None
+
+# Максимум одновременных отправок сообщений в Telegram
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv('TELEGRAM_SEND_CONCURRENCY', 8))
+
+# Очередь событий Notion: их обрабатывает один фоновый потребитель (_drain_events).
+# Очередь и событие остановки создаются в startup_event заново для каждого запуска приложения
+EVENT_QUEUE_MAXSIZE = 10_000
+_event_queue: Optional["asyncio.Queue[tuple]"] = None
+_drain_task: Optional[asyncio.Task] = None
+# Устанавливается в shutdown_event: фоновые циклы дорабатывают текущую очередь и завершаются
+_stop_event: Optional[asyncio.Event] = None
+# Сколько секунд при остановке ждать обработки оставшихся событий
+SHUTDOWN_DRAIN_TIMEOUT = 10
+# Окно (с), в котором события одной страницы схлопываются в одно
+EVENT_COALESCE_WINDOW = 0.05
+# Одновременно обрабатываемые события - держимся в пределах лимита запросов Notion API
+EVENT_PROCESS_CONCURRENCY = 2
+
+# Кэши справочных данных Notion: базы и родительские страницы меняются редко
+NOTION_CACHE_TTL = int(os.getenv('NOTION_CACHE_TTL', 300))
+_db_cache = TTLCache(maxsize=1024, ttl=NOTION_CACHE_TTL)
+_page_cache = TTLCache(maxsize=1024, ttl=NOTION_CACHE_TTL)
+_relation_title_cache = TTLCache(maxsize=1024, ttl=NOTION_CACHE_TTL)
+# Опции статуса - часть схемы базы, одинаковы для всех ее страниц
+_status_options_cache = TTLCache(maxsize=1024, ttl=NOTION_CACHE_TTL)
+# Id уже принятых webhook событий: Notion повторяет доставку, повтор обрабатывать не нужно
+_seen_events = TTLCache(maxsize=10_000, ttl=60)
+# Запросы в процессе выполнения: одновременные промахи по одному ключу ждут один вызов
+_inflight: Dict[tuple, asyncio.Future] = {}
+
+async def _cached(cache: TTLCache, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """Значение из кэша или результат fetch(); None не кэшируется"""
+    value = cache.get(key)
+    if value is not None:
+        return value
+    flight_key = (id(cache), key)
+    future = _inflight.get(flight_key)
+    if future is None:
+        future = asyncio.ensure_future(fetch())
+        _inflight[flight_key] = future
+        future.add_done_callback(lambda _: _inflight.pop(flight_key, None))
+    value = await asyncio.shield(future)
+    if value is not None:
+        cache[key] = value
+    return value
+
+def _format_notion_time(value: str) -> str:
+    """Время Notion в ISO 8601 ('2024-05-13T07:24:00.000Z') -> 'дд.мм.гггг чч:мм'"""
+    if not value:
+        return ''
+    # Notion отдает время фиксированного вида, поэтому достаточно срезов строки
+    if len(value) >= 16 and value[4] == '-' and value[7] == '-' and value[10] == 'T' and value[13] == ':':
+        return f"{value[8:10]}.{value[5:7]}.{value[0:4]} {value[11:13]}:{value[14:16]}"
+    try:
+        if ciso8601 is not None:
+            dt = ciso8601.parse_datetime(value)
+        else:
+            dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return dt.strftime('%d.%m.%Y %H:%M')
+    except (TypeError, ValueError):
+        return value
+
+# Варианты названия поля Ma'sul Xodim (ответственный сотрудник) в порядке приоритета
+_MASUL_XODIM_NAMES = (
+    "Ma'sul Xodim",
+    "Ma'sul shaxs",
+    "Masul Xodim",
+    "Masul shaxs",
+    "Ma'sul xodim",
+    "Masul xodim",
+    "Executor",
+    "Responsible",
+    "Ответственный"
+)
+# Relation-поля: название свойства в Notion -> ключ
+_RELATION_TARGETS = {
+    'Loyiha': 'loyiha',  # Loyiha (7-я колонка)
+    'Projects (1)': 'project_relation',
+    'Parent item': 'parent_item',
+    'Blocked by': 'blocked_by',
+    'Blocking': 'blocking',
+    'Sub-item': 'sub_item',
+}
+# Relation-свойства, для которых в сообщении нужны названия связанных страниц
+_RELATION_PROPS = frozenset(_RELATION_TARGETS) | frozenset(_MASUL_XODIM_NAMES)
+# Простые поля: название свойства в Notion -> (ключ, ожидаемый тип свойства)
+_TARGETS = {
+    'Description': ('description', 'rich_text'),
+    'Status': ('status', 'status'),
+    'Deadline': ('deadline', 'date'),  # Deadline (4-я колонка)
+    'Start Date': ('start_date', 'date'),
+    'Assigned By': ('assigned_by', 'people'),
+    'Telegram Username': ('telegram_username', 'multi_select'),
+    'Strategy file': ('strategy_file', 'files'),
+    'Strategy Link': ('strategy_link', 'url'),
+}
+# Извлечение значения свойства по его типу
+_EXTRACTORS = {
+    'rich_text': lambda prop: ''.join(item.get('plain_text', '') for item in prop.get('rich_text', [])),
+    'status': lambda prop: prop['status'].get('name', '') if prop.get('status') else '',
+    'date': lambda prop: prop['date'].get('start', '') if prop.get('date') else '',
+    'people': lambda prop: prop['people'][0].get('name', '') if prop.get('people') else '',
+    'multi_select': lambda prop: [item.get('name', '') for item in prop.get('multi_select', [])],
+    'files': lambda prop: [file.get('name', '') for file in prop.get('files', [])],
+    'url': lambda prop: prop.get('url') or '',
+}
+
+# Заголовки сообщения в Telegram по типу события
+_EVENT_HEADERS = {
+    "page.created": "🔔 <b>NEW TASK</b>\n\n",
+    "page.properties_updated": "🔔 <b>TASK UPDATE</b>\n\n",
+}
+
+@dataclass(slots=True)
+class ExtractedPage:
+    """Поля страницы Notion, извлеченные для сообщения в Telegram"""
+    id: str = ''
+    title: str = 'No Title'  # Vazifa nomi (1-я колонка)
+    department: str = ''
+    project: str = ''
+    tasks: str = ''
+    executor: str = ''  # Ma'sul Xodim (5-я колонка)
+    loyiha: str = ''  # Loyiha (7-я колонка)
+    project_relation: str = ''
+    parent_item: str = ''
+    blocked_by: str = ''
+    blocking: str = ''
+    sub_item: str = ''
+    description: str = ''
+    status: str = ''
+    deadline: str = ''  # Deadline (4-я колонка)
+    start_date: str = ''
+    assigned_by: str = ''
+    telegram_username: List[str] = field(default_factory=list)
+    strategy_file: List[str] = field(default_factory=list)
+    strategy_link: str = ''
+    url: str = ''
+    created_time: str = ''
+    last_edited_time: str = ''
+    archived: bool = False
+    in_trash: bool = False
 
 class WebhookProcessor:
-    def __init__(self):
-        self.webhook_secret = os.getenv('NOTION_WEBHOOK_SECRET')
+    def __init__(self, notion: Optional[NotionIntegration], telegram: Optional[TelegramIntegration]):
+        self.notion = notion
+        self.telegram = telegram
+        webhook_secret = os.getenv('NOTION_WEBHOOK_SECRET')
+        self.webhook_secret = webhook_secret.encode() if webhook_secret else None
+        # Отключение проверки подписи для отладки
+        self.skip_signature = os.getenv('NOTION_WEBHOOK_SKIP_SIGNATURE', '').lower() in ('1', 'true', 'yes')
         self.logger = logging.getLogger(__name__)
+        if self.skip_signature:
+            self.logger.warning("Проверка подписи webhook отключена (NOTION_WEBHOOK_SKIP_SIGNATURE)")
+        elif not self.webhook_secret:
+            self.logger.error("NOTION_WEBHOOK_SECRET не задан - webhook события Notion будут отклоняться (кроме запроса верификации подписки)")
+        # Отправки в Telegram идут фоновыми задачами; ссылки на задачи держим до их завершения
+        self._send_semaphore = asyncio.Semaphore(TELEGRAM_SEND_CONCURRENCY)
+        self._send_tasks = set()
     
     def verify_signature(self, body: bytes, signature: str) -> bool:
-        """Проверка подписи webhook"""
-        # Временно отключаем проверку подписи для отладки
-        self.logger.info("Пропускаем проверку подписи для отладки")
-        return True
+        """Проверка подписи webhook (HMAC-SHA256 от тела запроса)"""
+        if self.skip_signature:
+            return True
+        # Без секрета подпись проверить нечем - запрос отклоняется
+        if not self.webhook_secret:
+            return False
+        # Notion присылает подпись в виде "sha256=<hex>"
+        _, _, signature_hex = signature.rpartition('=')
+        try:
+            provided = bytes.fromhex(signature_hex)
+        except ValueError:
+            return False
+        expected = hmac.new(self.webhook_secret, body, hashlib.sha256).digest()
+        return hmac.compare_digest(expected, provided)
+    
+    async def _retrieve_database(self, database_id: str) -> Dict:
+        """Получение базы данных из Notion (кэшируется по id)"""
+        return await _cached(
+            _db_cache, database_id,
+            lambda: self.notion.aclient.databases.retrieve(database_id=database_id)
+        )
+    
+    async def _get_parent_page_data(self, page_id: str) -> Optional[Dict]:
+        """Получение родительской страницы (кэшируется по id)"""
+        return await _cached(_page_cache, page_id, lambda: self.notion.get_page_data(page_id))
+    
+    async def _get_related_title(self, related_id: str) -> Optional[str]:
+        """Название связанной страницы (кэшируется по id)"""
+        async def fetch():
+            related_data = await self.notion.get_page_data(related_id)
+            if related_data:
+                return self._extract_title(related_data.get('properties', {}))
+            return None
+        return await _cached(_relation_title_cache, related_id, fetch)
     
-    def get_database_name(self, database_id: str) -> str:
+    def _database_title(self, database_data: Dict) -> str:
+        """Название базы данных из ответа Notion"""
+        if database_data and 'title' in database_data and database_data['title']:
+            return database_data['title'][0].get('plain_text', 'Unknown Database')
+        return 'Unknown Database'
+    
+    async def get_database_name(self, database_id: str) -> str:
         """Получение названия базы данных"""
         try:
-            database_data = notion_client.client.databases.retrieve(database_id=database_id)
-            if database_data and 'title' in database_data and database_data['title']:
-                return database_data['title'][0].get('plain_text', 'Unknown Database')
-            return 'Unknown Database'
+            return self._database_title(await self._retrieve_database(database_id))
         except Exception as e:
             self.logger.error(f"Ошибка получения названия базы данных {database_id}: {e}")
             return 'Unknown Database'
     
-    def get_hierarchy_components(self, page_id: str, database_id: str = None) -> Dict[str, str]:
+    async def get_hierarchy_components(self, page_id: str, database_id: str = None) -> Dict[str, str]:
         """Получение компонентов иерархии отдельно"""
         try:
             hierarchy = {
@@ -142,52 +345,35 @@ class WebhookProcessor:
             
             if database_id:
                 self.logger.info(f"Using database_id from webhook: {database_id}")
-                database_name = self.get_database_name(database_id)
-                hierarchy['tasks'] = database_name
                 
-                # Получаем иерархию базы данных
+                # Получаем базу данных один раз: из нее берутся и название, и иерархия
                 try:
-                    database_data = notion_client.client.databases.retrieve(database_id=database_id)
+                    database_data = await self._retrieve_database(database_id)
+                    hierarchy['tasks'] = self._database_title(database_data)
                     db_parent = database_data.get('parent', {})
                     self.logger.info(f"Database parent: {db_parent}")
                     
                     if db_parent.get('type') == 'page_id':
                         parent_page_id = db_parent.get('page_id')
                         self.logger.info(f"Getting database parent page: {parent_page_id}")
-                        page_data = notion_client.get_page_data(parent_page_id)
+                        page_data = await self._get_parent_page_data(parent_page_id)
                         if page_data:
                             # Получаем заголовок родительской страницы
-                            title = "No Title"
-                            if 'properties' in page_data:
-                                for prop_name, prop_value in page_data['properties'].items():
-                                    if prop_value.get('type') == 'title':
-                                        title_array = prop_value.get('title', [])
-                                        if title_array:
-                                            title = title_array[0].get('plain_text', 'No Title')
-                                            break
-                            hierarchy['project'] = title
+                            hierarchy['project'] = self._extract_title(page_data.get('properties', {}))
                             
                             # Проверяем родителя страницы
                             parent = page_data.get('parent', {})
                             if parent.get('type') == 'page_id':
                                 parent_page_id = parent.get('page_id')
-                                parent_page_data = notion_client.get_page_data(parent_page_id)
+                                parent_page_data = await self._get_parent_page_data(parent_page_id)
                                 if parent_page_data:
-                                    parent_title = "No Title"
-                                    if 'properties' in parent_page_data:
-                                        for prop_name, prop_value in parent_page_data['properties'].items():
-                                            if prop_value.get('type') == 'title':
-                                                title_array = prop_value.get('title', [])
-                                                if title_array:
-                                                    parent_title = title_array[0].get('plain_text', 'No Title')
-                                                    break
-                                    hierarchy['department'] = parent_title
+                                    hierarchy['department'] = self._extract_title(parent_page_data.get('properties', {}))
                     elif db_parent.get('type') == 'block_id':
                         # База данных находится внутри блока
                         block_id = db_parent.get('block_id')
                         self.logger.info(f"Getting database parent block: {block_id}")
                         try:
-                            block_data = notion_client.client.blocks.retrieve(block_id=block_id)
+                            block_data = await self.notion.aclient.blocks.retrieve(block_id=block_id)
                             if block_data.get('type') == 'toggle':
                                 toggle_text = block_data.get('toggle', {}).get('rich_text', [])
                                 if toggle_text:
@@ -201,21 +387,14 @@ class WebhookProcessor:
                             if block_parent.get('type') == 'page_id':
                                 parent_page_id = block_parent.get('page_id')
                                 self.logger.info(f"Getting block parent page: {parent_page_id}")
-                                parent_page_data = notion_client.get_page_data(parent_page_id)
+                                parent_page_data = await self._get_parent_page_data(parent_page_id)
                                 if parent_page_data:
-                                    parent_title = "No Title"
-                                    if 'properties' in parent_page_data:
-                                        for prop_name, prop_value in parent_page_data['properties'].items():
-                                            if prop_value.get('type') == 'title':
-                                                title_array = prop_value.get('title', [])
-                                                if title_array:
-                                                    parent_title = title_array[0].get('plain_text', 'No Title')
-                                                    break
-                                    hierarchy['department'] = parent_title
+                                    hierarchy['department'] = self._extract_title(parent_page_data.get('properties', {}))
                         except Exception as e:
                             self.logger.error(f"Ошибка получения блока {block_id}: {e}")
                 except Exception as e:
                     self.logger.error(f"Ошибка получения базы данных {database_id}: {e}")
+                    hierarchy['tasks'] = hierarchy['tasks'] or 'Unknown Database'
             
             return hierarchy
             
@@ -223,102 +402,97 @@ class WebhookProcessor:
             self.logger.error(f"Ошибка получения компонентов иерархии для {page_id}: {e}")
             return {'department': '', 'project': '', 'tasks': ''}
     
-    def extract_all_fields(self, page_data: Dict, database_id: str = None) -> Dict:
-        """Извлечение ВСЕХ полей из страницы Notion"""
+    async def extract_all_fields(self, page_data: Dict, database_id: str = None,
+                                 hierarchy_task: asyncio.Task = None) -> ExtractedPage:
+        """Извлечение ВСЕХ полей из страницы Notion
+
+        hierarchy_task - уже запущенная загрузка get_hierarchy_components, если есть
+        """
         try:
             properties = page_data.get('properties', {})
             
             # Логируем все свойства для отладки
-            self.logger.info(f"Все свойства страницы: {list(properties.keys())}")
-            for prop_name, prop_value in properties.items():
-                prop_type = prop_value.get('type', 'unknown')
-                self.logger.info(f"  - {prop_name}: тип={prop_type}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(
+                    "Свойства страницы: %s",
+                    {prop_name: prop_value.get('type', 'unknown') for prop_name, prop_value in properties.items()}
+                )
             
-            # Получаем компоненты иерархии отдельно
-            hierarchy_components = self.get_hierarchy_components(page_data.get('id', ''), database_id)
+            extracted_data = ExtractedPage(
+                id=page_data.get('id', ''),
+                url=page_data.get('url', ''),
+                created_time=_format_notion_time(page_data.get('created_time', '')),
+                last_edited_time=_format_notion_time(page_data.get('last_edited_time', '')),
+                archived=page_data.get('archived', False),
+                in_trash=page_data.get('in_trash', False)
+            )
             
-            # Извлекаем ВСЕ возможные поля
-            extracted_data = {
-                'id': page_data.get('id', ''),
-                'title': self._extract_title(properties),  # Vazifa nomi (1-я колонка)
-                'department': hierarchy_components.get('department', ''),
-                'project': hierarchy_components.get('project', ''),
-                'tasks': hierarchy_components.get('tasks', ''),
-                'loyiha': self._extract_relation(properties, 'Loyiha'),  # Loyiha (7-я колонка)
-                'description': self._extract_rich_text(properties, 'Description'),
-                'status': self._extract_status(properties, 'Status'),
-                'deadline': self._extract_date(properties, 'Deadline'),  # Deadline (4-я колонка)
-                'start_date': self._extract_date(properties, 'Start Date'),
-                'executor': self._extract_masul_xodim(properties),  # Ma'sul Xodim (5-я колонка)
-                'assigned_by': self._extract_people(properties, 'Assigned By'),
-                'telegram_username': self._extract_multi_select(properties, 'Telegram Username'),
-                'project_relation': self._extract_relation(properties, 'Projects (1)'),
-                'parent_item': self._extract_relation(properties, 'Parent item'),
-                'blocked_by': self._extract_relation(properties, 'Blocked by'),
-                'blocking': self._extract_relation(properties, 'Blocking'),
-                'sub_item': self._extract_relation(properties, 'Sub-item'),
-                'strategy_file': self._extract_files(properties, 'Strategy file'),
-                'strategy_link': self._extract_url(properties, 'Strategy Link'),
-                'url': page_data.get('url', ''),
-                'created_time': self._extract_created_time(page_data),
-                'last_edited_time': self._extract_last_edited_time(page_data),
-                'archived': page_data.get('archived', False),
-                'in_trash': page_data.get('in_trash', False)
-            }
+            # Один проход по свойствам: заголовок, простые поля и id связанных страниц
+            related_ids = {}
+            for prop_name, prop in properties.items():
+                prop_type = prop.get('type')
+                if prop_type == 'title':
+                    title_array = prop.get('title', [])
+                    if title_array:
+                        extracted_data.title = title_array[0].get('plain_text', '')  # Vazifa nomi (1-я колонка)
+                elif prop_type == 'relation':
+                    if prop_name in _RELATION_PROPS:
+                        relation_array = prop.get('relation', [])
+                        if relation_array:
+                            related_ids[prop_name] = relation_array[0].get('id', '')
+                else:
+                    target = _TARGETS.get(prop_name)
+                    if target is not None and target[1] == prop_type:
+                        setattr(extracted_data, target[0], _EXTRACTORS[prop_type](prop))
+            
+            # Иерархия и связанные страницы не зависят друг от друга - запрашиваем параллельно
+            # Названия всех связанных страниц загружаются одним пакетом
+            unique_related_ids = list(dict.fromkeys(related_ids.values()))
+            if hierarchy_task is None:
+                hierarchy_task = self.get_hierarchy_components(page_data.get('id', ''), database_id)
+            hierarchy_components, *titles = await asyncio.gather(
+                hierarchy_task,
+                *[self._get_related_title(related_id) for related_id in unique_related_ids],
+                return_exceptions=True
+            )
+            if isinstance(hierarchy_components, Exception):
+                self.logger.error(f"Ошибка получения компонентов иерархии: {hierarchy_components}")
+                hierarchy_components = {}
+            related_titles = {}
+            for related_id, title in zip(unique_related_ids, titles):
+                if isinstance(title, Exception):
+                    self.logger.error(f"Ошибка получения названия связанного элемента {related_id}: {title}")
+                elif title:
+                    related_titles[related_id] = title
+            
+            extracted_data.department = hierarchy_components.get('department', '')
+            extracted_data.project = hierarchy_components.get('project', '')
+            extracted_data.tasks = hierarchy_components.get('tasks', '')
+            extracted_data.executor = self._extract_masul_xodim(properties, related_titles)  # Ma'sul Xodim (5-я колонка)
+            for prop_name, related_id in related_ids.items():
+                key = _RELATION_TARGETS.get(prop_name)
+                if key is not None:
+                    setattr(extracted_data, key, related_titles.get(related_id) or f"Related (ID: {related_id})")
             
             return extracted_data
             
         except Exception as e:
             self.logger.error(f"Ошибка извлечения полей: {e}")
-            return {}
+            return ExtractedPage()
     
     def _extract_title(self, properties: Dict) -> str:
         """Извлечение заголовка"""
-        for prop_name, prop_value in properties.items():
-            if prop_value.get('type') == 'title':
-                title_array = prop_value.get('title', [])
+        for prop in properties.values():
+            if prop.get('type') == 'title':
+                title_array = prop.get('title', [])
                 if title_array:
                     return title_array[0].get('plain_text', '')
         return 'No Title'
     
-    def _extract_rich_text(self, properties: Dict, prop_name: str) -> str:
-        """Извлечение текста из rich_text свойства"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'rich_text':
-            rich_text_array = prop.get('rich_text', [])
-            return ''.join([item.get('plain_text', '') for item in rich_text_array])
-        return ''
-    
-    def _extract_status(self, properties: Dict, prop_name: str) -> str:
-        """Извлечение статуса"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'status' and prop.get('status'):
-            return prop['status'].get('name', '')
-        return ''
-    
-    def _extract_date(self, properties: Dict, prop_name: str) -> str:
-        """Извлечение даты"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'date' and prop.get('date'):
-            return prop['date'].get('start', '')
-        return ''
-    
-    def _extract_masul_xodim(self, properties: Dict) -> str:
+    def _extract_masul_xodim(self, properties: Dict, related_titles: Dict[str, str]) -> str:
         """Извлечение Ma'sul Xodim (ответственный сотрудник) с разными вариантами названий"""
         # Пробуем разные варианты названий поля
-        possible_names = [
-            "Ma'sul Xodim",
-            "Ma'sul shaxs",
-            "Masul Xodim",
-            "Masul shaxs",
-            "Ma'sul xodim",
-            "Masul xodim",
-            "Executor",
-            "Responsible",
-            "Ответственный"
-        ]
-        
-        for prop_name in possible_names:
+        for prop_name in _MASUL_XODIM_NAMES:
             if prop_name in properties:
                 prop = properties[prop_name]
                 prop_type = prop.get('type', '')
@@ -337,141 +511,81 @@ class WebhookProcessor:
                     relation_array = prop.get('relation', [])
                     if relation_array:
                         related_id = relation_array[0].get('id', '')
-                        try:
-                            related_data = notion_client.get_page_data(related_id)
-                            if related_data:
-                                related_title = self._extract_title(related_data.get('properties', {}))
-                                if related_title:
-                                    self.logger.info(f"Найдено Ma'sul Xodim (relation): {prop_name} = {related_title}")
-                                    return related_title
-                        except Exception as e:
-                            self.logger.error(f"Ошибка получения Ma'sul Xodim из relation: {e}")
+                        related_title = related_titles.get(related_id)
+                        if related_title:
+                            self.logger.info(f"Найдено Ma'sul Xodim (relation): {prop_name} = {related_title}")
+                            return related_title
         
         self.logger.warning("Ma'sul Xodim не найден ни в одном из возможных полей")
         return ''
     
-    def _extract_people(self, properties: Dict, prop_name: str) -> str:
-        """Извлечение людей"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'people':
-            people_array = prop.get('people', [])
-            if people_array:
-                return people_array[0].get('name', '')
-        return ''
-    
-    def _extract_multi_select(self, properties: Dict, prop_name: str) -> list:
-        """Извлечение значений multi_select свойства"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'multi_select':
-            return [item.get('name', '') for item in prop.get('multi_select', [])]
-        return []
-    
-    def _extract_relation(self, properties: Dict, prop_name: str) -> str:
-        """Извлечение связи с получением названия"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'relation':
-            relation_array = prop.get('relation', [])
-            if relation_array:
-                related_id = relation_array[0].get('id', '')
-                # Получаем название связанной страницы
-                try:
-                    related_data = notion_client.get_page_data(related_id)
-                    if related_data:
-                        related_title = self._extract_title(related_data.get('properties', {}))
-                        return related_title if related_title else f"Related (ID: {related_id})"
-                    else:
-                        return f"Related (ID: {related_id})"
-                except Exception as e:
-                    self.logger.error(f"Ошибка получения названия связанного элемента: {e}")
-                    return f"Related (ID: {related_id})"
-        return ''
-    
-    def _extract_files(self, properties: Dict, prop_name: str) -> list:
-        """Извлечение файлов"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'files':
-            files_array = prop.get('files', [])
-            return [file.get('name', '') for file in files_array]
-        return []
-    
-    def _extract_url(self, properties: Dict, prop_name: str) -> str:
-        """Извлечение URL"""
-        prop = properties.get(prop_name, {})
-        if prop.get('type') == 'url' and prop.get('url'):
-            return prop['url']
-        return ''
-    
-    def _extract_created_time(self, page_data: Dict) -> str:
-        """Извлечение времени создания"""
-        created_time = page_data.get('created_time', '')
-        if created_time:
-            try:
-                dt = datetime.fromisoformat(created_time.replace('Z', '+00:00'))
-                return dt.strftime('%d.%m.%Y %H:%M')
-            except:
-                return created_time
-        return ''
-    
-    def _extract_last_edited_time(self, page_data: Dict) -> str:
-        """Извлечение времени последнего редактирования"""
-        last_edited_time = page_data.get('last_edited_time', '')
-        if last_edited_time:
-            try:
-                dt = datetime.fromisoformat(last_edited_time.replace('Z', '+00:00'))
-                return dt.strftime('%d.%m.%Y %H:%M')
-            except:
-                return last_edited_time
-        return ''
-    
-    def format_enhanced_telegram_message(self, data: Dict, change_type: str = "updated") -> str:
+    def format_enhanced_telegram_message(self, data: ExtractedPage, change_type: str = "updated") -> str:
         """Форматирование улучшенного сообщения для Telegram с ВСЕМИ данными"""
         try:
-            
-            # Определяем тип события
-            if change_type == "page.created":
-                event_text = "🔔 <b>NEW TASK</b>"
-            elif change_type == "page.properties_updated":
-                event_text = "🔔 <b>TASK UPDATE</b>"
-            else:
-                event_text = "🔔 <b>TASK CHANGE</b>"
-            
-            message = f"{event_text}\n\n"
+            # Заголовок по типу события
+            parts = [_EVENT_HEADERS.get(change_type, "🔔 <b>TASK CHANGE</b>\n\n")]
+            append = parts.append
             
             # 1. Vazifa nomi (название задачи)
-            title = data.get('title', 'No Title')
+            title = data.title
             if title:
-                message += f"📌 <b>Vazifa nomi:</b> {title}\n"
+                append(f"📌 <b>Vazifa nomi:</b> {title}\n")
             
             # 2. Proekt (проект из поля loyiha)
-            loyiha = data.get('loyiha', '')
+            loyiha = data.loyiha
             if loyiha:
-                message += f"📁 <b>Proekt:</b> {loyiha}\n"
+                append(f"📁 <b>Proekt:</b> {loyiha}\n")
             
             # 3. Deadline (дедлайн)
-            deadline = data.get('deadline', '')
+            deadline = data.deadline
             if deadline:
-                message += f"⏰ <b>Deadline:</b> {deadline}\n"
+                append(f"⏰ <b>Deadline:</b> {deadline}\n")
             
             # 4. Masul shaxs (ответственный сотрудник)
-            executor = data.get('executor', '')
+            executor = data.executor
             if executor:
-                message += f"👤 <b>Masul shaxs:</b> {executor}\n"
+                append(f"👤 <b>Masul shaxs:</b> {executor}\n")
             
             # Ссылка на Notion
-            if data.get('url'):
-                message += f"\n🔗 <a href='{data.get('url')}'>Open in Notion</a>"
+            url = data.url
+            if url:
+                append(f"\n🔗 <a href='{url}'>Open in Notion</a>")
             
-            return message
+            return "".join(parts)
             
         except Exception as e:
             self.logger.error(f"Ошибка форматирования сообщения: {e}")
-            return f"📝 Notion Update: {data.get('title', 'No Title')}"
+            return f"📝 Notion Update: {data.title}"
+    
+    async def process_webhook_event_raw(self, body: bytes, event_data: Dict[str, Any]) -> bool:
+        """Обработка webhook события вместе с исходным телом запроса"""
+        return await self.process_webhook_event(event_data, raw_body=body)
     
-    async def process_webhook_event(self, event_data: Dict[str, Any]) -> bool:
+    async def process_webhook_event(self, event_data: Dict[str, Any], raw_body: bytes = None) -> bool:
         """Обработка webhook события"""
         try:
+            # Повторная доставка того же события - уже обработано
+            # Проверка и запись идут без await между ними, поэтому в одном event loop блокировка не нужна
+            event_id = event_data.get('id')
+            if event_id:
+                if event_id in _seen_events:
+                    self.logger.info(f"Повторная доставка события {event_id} - пропускаем")
+                    return True
+                _seen_events[event_id] = True
+            
             # Логируем полные данные события для отладки
-            self.logger.info(f"Полные данные события: {json.dumps(event_data, indent=2)}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                if raw_body is not None:
+                    # Исходное тело уже есть - повторно сериализовать событие не нужно
+                    self.logger.debug("Полные данные события: %s", raw_body.decode('utf-8', 'replace'))
+                else:
+                    self.logger.debug("Полные данные события: %s", orjson.dumps(event_data, option=orjson.OPT_INDENT_2).decode())
+            
+            # Верификационный токен (тело в DEBUG не видно) - печатаем его значение,
+            # чтобы оператор мог указать его в Notion
+            if 'verification_token' in event_data:
+                self.logger.warning(f"Получен верификационный токен Notion: {event_data['verification_token']}")
+                return False
             
             event_type = event_data.get('type')
             
@@ -513,11 +627,6 @@ class WebhookProcessor:
                 return False
             
             else:
-                # Проверяем на верификационные токены
-                if 'verification_token' in event_data:
-                    self.logger.info("Получен верификационный токен - игнорируем")
-                    return False
-                
                 self.logger.info(f"Игнорируем событие типа: {event_type}")
                 return False
                 
@@ -528,36 +637,183 @@ class WebhookProcessor:
     async def _process_page_event(self, event_type: str, page_id: str, database_id: str = None) -> bool:
         """Обработка события страницы с полными данными"""
         try:
+            # Иерархия зависит только от database_id - загружаем ее параллельно со страницей
+            hierarchy_task = asyncio.create_task(self.get_hierarchy_components(page_id, database_id))
+            
             # Получаем данные страницы из Notion
-            page_data = notion_client.get_page_data(page_id)
+            page_data = await self.notion.get_page_data(page_id)
             if not page_data:
+                hierarchy_task.cancel()
                 self.logger.warning(f"Не удалось получить данные страницы {page_id}")
                 return False
             
             # Извлекаем ВСЕ поля с database_id
-            extracted_data = self.extract_all_fields(page_data, database_id)
-            self.logger.info(f"Извлеченные данные: {extracted_data}")
+            extracted_data = await self.extract_all_fields(page_data, database_id, hierarchy_task)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Извлеченные данные: %s", orjson.dumps(extracted_data, option=orjson.OPT_INDENT_2).decode())
             
             # Форматируем улучшенное сообщение
             formatted_message = self.format_enhanced_telegram_message(extracted_data, event_type)
             
-            # Отправляем в Telegram с полными данными (без inline кнопок)
-            success = await telegram_client.send_custom_message(formatted_message)
+            # Отправляем в Telegram с полными данными (без inline кнопок) в фоне - ответ Telegram не ждем
+            task = asyncio.create_task(self._send_to_telegram(formatted_message, event_type, page_id))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"Ошибка при получении данных страницы {page_id}: {e}")
+            return False
+    
+    async def _send_to_telegram(self, message: str, event_type: str, page_id: str) -> bool:
+        """Отправка сообщения в Telegram с ограничением числа одновременных запросов"""
+        try:
+            async with self._send_semaphore:
+                success = await self.telegram.send_custom_message(message)
             if success:
                 self.logger.info(f"Событие {event_type} с полными данными успешно обработано для страницы {page_id}")
             else:
                 self.logger.error(f"Ошибка при отправке полных данных в Telegram для страницы {page_id}")
-            
             return success
-            
         except Exception as e:
-            self.logger.error(f"Ошибка при получении данных страницы {page_id}: {e}")
+            self.logger.error(f"Ошибка при отправке в Telegram для страницы {page_id}: {e}")
             return False
+    
+    async def wait_pending_sends(self):
+        """Ожидание отправок в Telegram, еще не завершившихся к моменту остановки"""
+        if self._send_tasks:
+            await asyncio.gather(*self._send_tasks, return_exceptions=True)
+
+async def _wait_stop(timeout: float) -> bool:
+    """Пауза до timeout секунд, прерываемая остановкой сервера; True - сервер останавливается"""
+    try:
+        await asyncio.wait_for(_stop_event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+def _event_key(event_data: Any) -> Any:
+    """Ключ схлопывания события: id страницы из entity, иначе id самого объекта события"""
+    entity = event_data.get('entity') if isinstance(event_data, dict) else None
+    page_id = entity.get('id') if isinstance(entity, dict) else None
+    return page_id if isinstance(page_id, str) and page_id else id(event_data)
+
+def _on_drain_done(task: asyncio.Task):
+    """Потребитель очереди не должен завершаться молча - иначе события копятся без обработки"""
+    if task.cancelled():
+        logger.warning("Обработчик очереди событий Notion отменен")
+    elif task.exception() is not None:
+        logger.error(f"Обработчик очереди событий Notion завершился с ошибкой: {task.exception()}")
+    elif not _stop_event.is_set():
+        logger.error("Обработчик очереди событий Notion неожиданно завершился")
 
-# Инициализация процессора
-webhook_processor = WebhookProcessor()
+async def _drain_events(processor: WebhookProcessor):
+    """Фоновая обработка очереди событий Notion"""
+    semaphore = asyncio.Semaphore(EVENT_PROCESS_CONCURRENCY)
+    # Обрабатываемые события: ссылки на задачи держим до их завершения
+    tasks = set()
+
+    async def process(body: bytes, event_data: Dict[str, Any]):
+        try:
+            await processor.process_webhook_event_raw(body, event_data)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке события Notion: {e}")
+        finally:
+            semaphore.release()
+
+    async def dispatch(batch: List[Optional[tuple]]):
+        # Для каждой страницы достаточно последнего события - данные все равно читаются из Notion заново
+        latest = {}
+        for item in batch:
+            if item is None:  # пробуждение при остановке
+                continue
+            body, event_data = item
+            latest[_event_key(event_data)] = (body, event_data)
+        received = len(batch) - batch.count(None)
+        if len(latest) < received:
+            logger.info(f"Схлопнуто событий: {received - len(latest)} из {received}")
+        
+        # Каждое событие - отдельная задача: медленный запрос к Notion не задерживает остальные.
+        # Слот семафора занимаем до запуска задачи, поэтому при занятых слотах
+        # новые события ждут в очереди (и схлопываются там), а не копятся задачами
+        for body, event_data in latest.values():
+            await semaphore.acquire()
+            task = asyncio.create_task(process(body, event_data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    events, stop_event = _event_queue, _stop_event
+    while not stop_event.is_set():
+        batch = [await events.get()]
+        try:
+            # Собираем события, пришедшие за короткое окно (остановка сервера прерывает ожидание)
+            await _wait_stop(EVENT_COALESCE_WINDOW)
+            while not events.empty():
+                batch.append(events.get_nowait())
+            await dispatch(batch)
+        except Exception as e:
+            # Ошибка одного пакета не должна останавливать обработку очереди
+            logger.error(f"Ошибка при обработке пакета событий Notion: {e}")
+    
+    # После остановки дорабатываем события, принятые во время последнего пакета
+    while not events.empty():
+        batch = []
+        while not events.empty():
+            batch.append(events.get_nowait())
+        await dispatch(batch)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 # Обработчики Telegram сообщений
+_STATUS_LINE_RE = re.compile(r'🔹 <b>Status:</b> .+')
+_STATUS_LINE_TMPL = '🔹 <b>Status:</b> {}'.format
+_STATUS_LIST_TMPL = (
+    "Доступные статусы для страницы {page_id}:\n\n{status_list}\n\n"
+    "Для изменения статуса используйте API Notion напрямую."
+).format
+# callback_data кнопок статуса: status:<page_id>:<status_name> (имя статуса может содержать двоеточия)
+# id страницы - 32 hex символа или UUID с дефисами; сопоставление через fullmatch (без "\n" в конце)
+_CB_RE = re.compile(
+    r'status:((?:[0-9a-f]{32}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})):(.+)'
+)
+# Отправляемые в фоне ответы на callback: ссылки держим до завершения задач
+_ack_tasks = set()
+
+def _on_ack_done(task: asyncio.Task):
+    """Завершение фонового ответа на callback"""
+    _ack_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка при отправке ответа на callback: {task.exception()}")
+
+async def _answer_alert(query, text: str, ack_task: Optional[asyncio.Task] = None):
+    """Ответ на callback с alert: сначала дожидаемся фонового пустого ответа, чтобы они не гонялись"""
+    if ack_task is not None:
+        # Ошибку фонового ответа уже логирует _on_ack_done
+        await asyncio.wait((ack_task,))
+    await query.answer(text, show_alert=True)
+
+async def _get_status_options(notion: NotionIntegration, page: Dict, status_property_name: str = None) -> List[str]:
+    """Доступные опции статуса страницы (схема базы кэшируется по database_id)"""
+    if not status_property_name:
+        status_property_name = next(
+            (name for name, prop in page.get('properties', {}).items() if prop.get('type') == 'status'), None
+        )
+    parent = page.get('parent', {})
+    if not status_property_name or parent.get('type') != 'database_id':
+        return []
+    database_id = parent.get('database_id')
+
+    async def fetch():
+        db_info = await notion.aclient.databases.retrieve(database_id=database_id)
+        return {
+            name: [option.get('name') for option in prop.get('status', {}).get('options', [])]
+            for name, prop in db_info.get('properties', {}).items()
+            if prop.get('type') == 'status'
+        }
+
+    options_by_prop = await _cached(_status_options_cache, database_id, fetch)
+    return options_by_prop.get(status_property_name, [])
+
 async def start_command(update: Update, context):
     """Обработчик команды /start"""
     try:
@@ -570,7 +826,7 @@ async def start_command(update: Update, context):
             "Нажмите на кнопки статуса под сообщениями о задачах!"
         )
     except Exception as e:
-        logger.error(f"Ошибка в start_command: {e}", exc_info=True)
+        logger.error(f"Ошибка в start_command: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
 
 async def handle_message(update: Update, context):
     """Обработчик текстовых сообщений"""
@@ -583,14 +839,18 @@ async def handle_message(update: Update, context):
         # Если сообщение начинается с /status, обрабатываем команду
         if text.startswith('/status '):
             page_id = text.replace('/status ', '').strip()
-            if page_id and notion_client:
+            notion = app.state.notion
+            if page_id and notion:
                 # Получаем доступные статусы
-                status_options = notion_client.get_page_status_options(page_id)
+                try:
+                    page = await notion.aclient.pages.retrieve(page_id=page_id)
+                    status_options = await _get_status_options(notion, page)
+                except Exception as e:
+                    logger.error(f"Ошибка получения опций статуса для {page_id}: {e}")
+                    status_options = []
                 if status_options:
-                    status_list = "\n".join([f"- {status}" for status in status_options])
                     await update.message.reply_text(
-                        f"Доступные статусы для страницы {page_id}:\n\n{status_list}\n\n"
-                        f"Для изменения статуса используйте API Notion напрямую."
+                        _STATUS_LIST_TMPL(page_id=page_id, status_list="- " + "\n- ".join(status_options))
                     )
                 else:
                     await update.message.reply_text("Не удалось получить список статусов")
@@ -606,10 +866,8 @@ async def handle_message(update: Update, context):
 
 async def handle_callback(update: Update, context):
     """Обработчик callback от inline кнопок"""
-    global notion_client
-    logger.info(f"🎯 ===== handle_callback ВЫЗВАН =====")
-    logger.info(f"🎯 Update ID: {update.update_id}")
-    logger.info(f"🎯 Context: {context}")
+    _dbg("handle_callback: update_id=%s", update.update_id)
+    ack_task = None
     try:
         if not update.callback_query:
             logger.error("❌ update.callback_query is None!")
@@ -617,6 +875,14 @@ async def handle_callback(update: Update, context):
             return
         
         query = update.callback_query
+        
+        # Без Notion клиента обработать callback нельзя - отвечаем сразу, не разбирая данные
+        notion = app.state.notion
+        if notion is None:
+            logger.error("❌ Notion клиент не инициализирован в handle_callback!")
+            await query.answer("❌ Notion клиент не инициализирован", show_alert=True)
+            return
+        
         if not query.data:
             logger.error("❌ query.data is None!")
             await query.answer("❌ Ошибка: нет данных в callback", show_alert=True)
@@ -625,43 +891,26 @@ async def handle_callback(update: Update, context):
         data = query.data
         user = query.from_user
         
-        logger.info(f"🔔 ===== CALLBACK RECEIVED =====")
-        logger.info(f"🔔 Callback data: {data}")
-        logger.info(f"🔔 От пользователя: {user.username or user.first_name if user else 'Unknown'} (ID: {user.id if user else 'N/A'})")
-        logger.info(f"🔔 Update ID: {update.update_id}")
-        logger.info(f"🔔 Message ID: {query.message.message_id if query.message else 'N/A'}")
-        logger.info(f"🔔 =============================")
-        
-        # Проверяем доступность notion_client
-        if notion_client is None:
-            logger.error("❌ notion_client is None в handle_callback!")
-            await query.answer("❌ Notion клиент не инициализирован", show_alert=True)
-            return
+        logger.info(f"🔔 Callback: {data} от {user.username or user.first_name if user else 'Unknown'}")
+        _dbg("🔔 Callback: user_id=%s, update_id=%s, message_id=%s",
+             user.id if user else 'N/A', update.update_id, query.message.message_id if query.message else 'N/A')
         
-        logger.info(f"✅ notion_client доступен: {type(notion_client)}")
-        
-        # Сначала отвечаем на callback (важно делать это сразу)
-        try:
-            await query.answer()
-            logger.info("✅ Ответ на callback отправлен")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке ответа на callback: {e}")
+        # Сначала отвечаем на callback (важно делать это сразу): пустой ответ убирает
+        # индикатор загрузки у пользователя и уходит параллельно с запросами к Notion
+        ack_task = asyncio.create_task(query.answer())
+        _ack_tasks.add(ack_task)
+        ack_task.add_done_callback(_on_ack_done)
         
         if data.startswith('status:'):
-            # Формат: status:page_id:status_name
-            # Важно: status_name может содержать двоеточия, поэтому используем split с ограничением
-            parts = data.split(':', 2)  # Разделяем максимум на 3 части
-            if len(parts) == 3:
-                page_id = parts[1]
-                status_name = parts[2]  # Все что после второго двоеточия - это имя статуса
-                
+            match = _CB_RE.fullmatch(data)
+            if match:
+                page_id, status_name = match.groups()
                 logger.info(f"🔄 Обновление статуса для страницы {page_id} на '{status_name}'")
-                logger.info(f"📋 Разобранный callback: page_id={page_id}, status_name={status_name}")
                 
-                if notion_client:
+                if notion:
                     # Находим название свойства статуса
                     try:
-                        page = notion_client.client.pages.retrieve(page_id=page_id)
+                        page = await notion.aclient.pages.retrieve(page_id=page_id)
                         properties = page.get('properties', {})
                         status_property_name = None
                         
@@ -671,12 +920,11 @@ async def handle_callback(update: Update, context):
                                 break
                         
                         if status_property_name:
-                            logger.info(f"Найдено свойство статуса: {status_property_name}")
+                            _dbg("Найдено свойство статуса: %s", status_property_name)
                             
                             # Получаем доступные опции статуса для проверки
-                            available_statuses = notion_client.get_page_status_options(page_id)
-                            logger.info(f"📋 Доступные статусы: {available_statuses}")
-                            logger.info(f"📋 Запрашиваемый статус: '{status_name}'")
+                            available_statuses = await _get_status_options(notion, page, status_property_name)
+                            _dbg("📋 Доступные статусы: %s, запрашиваемый: '%s'", available_statuses, status_name)
                             
                             # Проверяем, что статус существует в опциях
                             if status_name not in available_statuses:
@@ -695,107 +943,123 @@ async def handle_callback(update: Update, context):
                                     status_name = matching_status
                                     logger.info(f"🔄 Используем статус: '{status_name}'")
                                 else:
-                                    await query.answer(f"❌ Статус '{status_name}' не найден", show_alert=True)
+                                    await _answer_alert(query, f"❌ Статус '{status_name}' не найден", ack_task)
                                     return
                             
                             # Обновляем статус в Notion
                             logger.info(f"🔄 Обновление статуса в Notion: {status_property_name} = '{status_name}'")
-                            success = notion_client.update_page_property(
+                            success = await notion.update_page_property(
                                 page_id=page_id,
                                 property_name=status_property_name,
-                                property_value=status_name
+                                property_value=status_name,
+                                prop_type='status'  # страница уже получена выше - повторный запрос не нужен
                             )
                             
                             if success:
                                 logger.info(f"Статус успешно обновлен в Notion: {status_name}")
                                 
+                                # Telegram принимает один ответ на callback - дожидаемся фонового пустого ответа
+                                # (его ошибку логирует _on_ack_done); подтверждение и правка сообщения
+                                # независимы - отправляем их параллельно
+                                await asyncio.wait((ack_task,))
+                                pending = [query.answer(f"✅ Статус изменен на: {status_name}", show_alert=False)]
+                                
                                 # Обновляем сообщение, если оно существует
                                 if query.message:
-                                    try:
-                                        # Получаем текущее сообщение
-                                        message_text = query.message.text or query.message.caption or ""
-                                        
-                                        # Обновляем статус в тексте сообщения
-                                        updated_text = re.sub(
-                                            r'🔹 <b>Status:</b> .+',
-                                            f'🔹 <b>Status:</b> {status_name}',
-                                            message_text
-                                        )
-                                        
-                                        # Обновляем сообщение
-                                        await query.edit_message_text(
-                                            text=updated_text,
-                                            parse_mode="HTML"
-                                        )
-                                        
-                                        logger.info(f"✅ Сообщение обновлено со статусом: {status_name}")
-                                    except Exception as e:
-                                        logger.error(f"Ошибка при обновлении сообщения: {e}", exc_info=True)
+                                    # Получаем текущее сообщение
+                                    message_text = query.message.text or query.message.caption or ""
+                                    
+                                    # Обновляем статус в тексте сообщения
+                                    updated_text = _STATUS_LINE_RE.sub(
+                                        _STATUS_LINE_TMPL(html.escape(status_name, quote=False)),
+                                        message_text
+                                    )
+                                    
+                                    # Без строки статуса текст не меняется - Telegram ответит
+                                    # "message is not modified", поэтому запрос не отправляем
+                                    if updated_text != message_text:
+                                        pending.append(query.edit_message_text(text=updated_text, parse_mode="HTML"))
                                 
-                                # Отправляем подтверждение
-                                await query.answer(f"✅ Статус изменен на: {status_name}", show_alert=False)
+                                answer_result, *edit_results = await asyncio.gather(*pending, return_exceptions=True)
+                                if isinstance(answer_result, Exception):
+                                    logger.error(f"Ошибка при отправке подтверждения: {answer_result}")
+                                for edit_result in edit_results:
+                                    if isinstance(edit_result, BadRequest) and "not modified" in str(edit_result):
+                                        logger.debug("edit skipped: %s", edit_result)
+                                    elif isinstance(edit_result, Exception):
+                                        logger.error(f"Ошибка при обновлении сообщения: {edit_result}")
+                                    else:
+                                        logger.info(f"✅ Сообщение обновлено со статусом: {status_name}")
                             else:
                                 logger.error("Не удалось обновить статус в Notion")
-                                await query.answer("❌ Ошибка при обновлении статуса в Notion", show_alert=True)
+                                await _answer_alert(query, "❌ Ошибка при обновлении статуса в Notion", ack_task)
                         else:
                             logger.warning("Свойство статуса не найдено")
-                            await query.answer("❌ Свойство статуса не найдено", show_alert=True)
+                            await _answer_alert(query, "❌ Свойство статуса не найдено", ack_task)
                     except Exception as e:
-                        logger.error(f"Ошибка при обработке callback: {e}", exc_info=True)
-                        await query.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+                        logger.error(f"Ошибка при обработке callback: {e}")
+                        await _answer_alert(query, f"❌ Ошибка: {str(e)}", ack_task)
                 else:
                     logger.error("Notion клиент не инициализирован")
-                    await query.answer("❌ Notion клиент не инициализирован", show_alert=True)
+                    await _answer_alert(query, "❌ Notion клиент не инициализирован", ack_task)
             else:
                 logger.warning(f"⚠️ Неверный формат callback data: {data}")
                 logger.warning(f"⚠️ Ожидался формат: status:page_id:status_name")
-                logger.warning(f"⚠️ Получено частей после split: {len(parts)}")
                 try:
-                    await query.answer("❌ Неверный формат данных", show_alert=True)
+                    await _answer_alert(query, "❌ Неверный формат данных", ack_task)
                 except Exception as e:
                     logger.error(f"Ошибка при отправке ответа: {e}")
         else:
             logger.warning(f"⚠️ Неизвестный тип callback: {data}")
             logger.warning(f"⚠️ Callback не начинается с 'status:'")
             try:
-                await query.answer("❌ Неизвестная команда", show_alert=True)
+                await _answer_alert(query, "❌ Неизвестная команда", ack_task)
             except Exception as e:
                 logger.error(f"Ошибка при отправке ответа: {e}")
     except Exception as e:
         logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА в handle_callback: {e}", exc_info=True)
         try:
             if update.callback_query:
-                await update.callback_query.answer(f"❌ Ошибка: {str(e)[:50]}", show_alert=True)
+                await _answer_alert(update.callback_query, f"❌ Ошибка: {str(e)[:50]}", ack_task)
         except Exception as e2:
             logger.error(f"Не удалось отправить ответ об ошибке: {e2}")
 
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске"""
-    global notion_client, telegram_client, telegram_app
+    global _drain_task, _event_queue, _stop_event
+    notion_client = telegram_client = telegram_app = None
     
     try:
+        # NotionIntegration сам владеет своим пулом соединений (keep-alive, HTTP/2): SDK
+        # перезаписывает base_url и Authorization клиента, поэтому делить его нельзя.
+        # Telegram ходит через пул Application.bot
         notion_client = NotionIntegration(
             token=os.getenv('NOTION_TOKEN'),
             database_id=os.getenv('NOTION_DATABASE_ID')
         )
+        app.state.notion = notion_client
         logger.info("Notion клиент инициализирован")
     except Exception as e:
         logger.error(f"Ошибка инициализации Notion клиента: {e}")
     
     try:
-        telegram_client = TelegramIntegration(
-            bot_token=os.getenv('TELEGRAM_BOT_TOKEN'),
-            channel_id=os.getenv('TELEGRAM_CHANNEL_ID')
-        )
-        logger.info("Telegram клиент инициализирован")
-        
         # Инициализируем Telegram Application для обработки сообщений через webhook
         bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
         if bot_token:
-            global telegram_app
             telegram_app = Application.builder().token(bot_token).build()
-            
+            app.state.telegram_app = telegram_app
+        
+        # Отправка в канал использует бота Application - отдельный Bot со своим пулом не нужен
+        telegram_client = TelegramIntegration(
+            bot_token=bot_token,
+            channel_id=os.getenv('TELEGRAM_CHANNEL_ID'),
+            bot=telegram_app.bot if telegram_app else None
+        )
+        app.state.telegram = telegram_client
+        logger.info("Telegram клиент инициализирован")
+        
+        if telegram_app:
             # Добавляем обработчики (важен порядок: CallbackQueryHandler должен быть перед MessageHandler)
             logger.info("Добавление обработчиков Telegram...")
             telegram_app.add_handler(CommandHandler("start", start_command))
@@ -836,19 +1100,51 @@ async def startup_event():
                 logger.error(f"Ошибка при настройке Telegram webhook: {e}", exc_info=True)
     except Exception as e:
         logger.error(f"Ошибка инициализации Telegram клиента: {e}")
+    
+    # Обработчик событий получает клиенты явно и запускается вместе с очередью
+    app.state.webhook_processor = WebhookProcessor(notion_client, telegram_client)
+    _event_queue = asyncio.Queue(maxsize=EVENT_QUEUE_MAXSIZE)
+    _stop_event = asyncio.Event()
+    _drain_task = asyncio.create_task(_drain_events(app.state.webhook_processor))
+    _drain_task.add_done_callback(_on_drain_done)
+
+# Ответы, не зависящие от содержимого запроса, сериализуются один раз
+_ROOT_RESPONSE = Response(
+    content=b'{"message":"Notion-Telegram Webhook Server - SEPARATED HIERARCHY","status":"running"}',
+    media_type="application/json"
+)
+_CORS_OK = Response(
+    content=b'{"status":"ok"}',
+    media_type="application/json",
+    headers={
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+        "Access-Control-Allow-Headers": "*",
+    }
+)
+_NO_VERIFICATION_TOKEN_RESPONSE = Response(
+    content=b'{"status":"error","message":"no verification token provided"}',
+    status_code=400,
+    media_type="application/json"
+)
 
 @app.get("/")
 async def root():
     """Корневой endpoint для проверки работы"""
-    return {"message": "Notion-Telegram Webhook Server - SEPARATED HIERARCHY", "status": "running"}
+    return _ROOT_RESPONSE
+
+# Время запуска фиксируется один раз; /health считает только uptime по монотонным часам
+_server_started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+_proc_start = time.monotonic()
 
 @app.get("/health")
-async def health_check():
+async def health_check(request: Request):
     """Проверка здоровья сервера"""
     return {
         "status": "healthy",
-        "telegram": "ok" if telegram_client else "error",
-        "timestamp": datetime.now().isoformat()
+        "telegram": "ok" if request.app.state.telegram else "error",
+        "started_at": _server_started_at,
+        "uptime_s": round(time.monotonic() - _proc_start, 1)
     }
 
 @app.get("/test/notion-webhook")
@@ -862,11 +1158,12 @@ async def test_notion_webhook():
     }
 
 @app.get("/telegram/webhook/status")
-async def telegram_webhook_status():
+async def telegram_webhook_status(request: Request):
     """Проверка статуса Telegram webhook"""
     try:
+        telegram_app = request.app.state.telegram_app
         if not telegram_app:
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=503,
                 content={"status": "error", "message": "Telegram application not initialized"}
             )
@@ -883,115 +1180,139 @@ async def telegram_webhook_status():
             "max_connections": webhook_info.max_connections
         }
     except Exception as e:
-        logger.error(f"Ошибка при получении статуса webhook: {e}", exc_info=True)
-        return JSONResponse(
+        logger.error(f"Ошибка при получении статуса webhook: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
+        return ORJSONResponse(
             status_code=500,
             content={"status": "error", "message": str(e)}
         )
 
-@app.get("/webhook/notion")
-async def webhook_verification(challenge: str = None, verification: str = None):
-    """Обработка запросов верификации на /webhook/notion"""
-    # Notion может отправлять параметр как "challenge" или "verification"
-    token = challenge or verification
-    if token:
-        logger.info(f"🔍 GET /webhook/notion - Получен токен для верификации: {token}")
-        response_data = {"challenge": token}
-        logger.info(f"📤 Отправляем ответ: {response_data}")
-        return JSONResponse(content=response_data, headers={"Content-Type": "application/json"})
-    logger.warning("⚠️ GET /webhook/notion - Запрос без токена")
-    return JSONResponse(
-        content={"status": "error", "message": "no challenge provided"},
-        headers={"Content-Type": "application/json"}
-    )
-
 @app.options("/notion-webhook")
 async def notion_webhook_options():
     """Обработка OPTIONS запросов для CORS"""
-    return JSONResponse(
-        content={"status": "ok"},
-        headers={
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-            "Access-Control-Allow-Headers": "*",
-        }
-    )
+    return _CORS_OK
 
-@app.get("/notion-webhook")
-async def notion_webhook_verification(request: Request):
-    """Обработка верификации webhook от Notion на /notion-webhook"""
+async def _handle_challenge(request: Request):
+    """Обработка верификации webhook от Notion (GET /webhook/notion и /notion-webhook)"""
     try:
-        # Логируем все query параметры
-        all_params = dict(request.query_params)
-        logger.info(f"🔍 GET /notion-webhook - Все query параметры: {all_params}")
+        _dbg("🔍 GET %s - query параметры: %s", request.url.path, request.query_params)
         
         # Notion может отправлять параметр как "verification" или "challenge"
         verification_token = request.query_params.get("verification") or request.query_params.get("challenge")
         
         if verification_token:
-            logger.info(f"✅ === NOTION VERIFICATION REQUEST ===")
-            logger.info(f"Token: {verification_token}")
-            logger.info(f"Time: {datetime.now()}")
-            logger.info(f"Full URL: {request.url}")
-            logger.info(f"IP: {request.client.host if request.client else 'Unknown'}")
-            logger.info(f"Headers: {dict(request.headers)}")
-            logger.info(f"====================================")
+            logger.info(f"✅ Запрос верификации Notion от {request.client.host if request.client else 'Unknown'}")
+            _dbg("Token: %s, URL: %s, headers: %s", verification_token, request.url, request.headers)
             
             # Notion ожидает получить токен обратно в ответе в формате {"challenge": token}
-            response_data = {"challenge": verification_token}
-            logger.info(f"📤 Отправляем ответ: {response_data}")
-            
-            # Явно возвращаем JSONResponse с правильным содержимым
-            return JSONResponse(
-                content=response_data,
-                headers={"Content-Type": "application/json"}
-            )
+            return Response(orjson.dumps({"challenge": verification_token}), media_type="application/json")
         
-        logger.warning(f"⚠️ Верификационный запрос без токена. Query params: {all_params}")
-        return JSONResponse(
-            status_code=400,
-            content={"status": "error", "message": "no verification token provided"},
-            headers={"Content-Type": "application/json"}
-        )
+        logger.warning(f"⚠️ Верификационный запрос без токена на {request.url.path}. Query params: {request.url.query}")
+        return _NO_VERIFICATION_TOKEN_RESPONSE
     except Exception as e:
-        logger.error(f"❌ Ошибка при обработке верификации: {e}", exc_info=True)
-        return JSONResponse(
+        logger.error(f"❌ Ошибка при обработке верификации: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
+        return ORJSONResponse(
             status_code=500,
-            content={"status": "error", "message": str(e)},
-            headers={"Content-Type": "application/json"}
+            content={"status": "error", "message": str(e)}
         )
 
-@app.post("/notion-webhook")
-async def notion_webhook_post(request: Request, background_tasks: BackgroundTasks):
-    """Обработка POST запросов от Notion на /notion-webhook"""
+app.add_api_route("/webhook/notion", _handle_challenge, methods=["GET"])
+app.add_api_route("/notion-webhook", _handle_challenge, methods=["GET"])
+
+# Ответ на принятое событие Notion сериализуется один раз
+_EVENT_ACCEPTED_RESPONSE = Response(
+    content=orjson.dumps({"status": "ok", "message": "Event processed"}),
+    media_type="application/json"
+)
+
+# Максимальный размер тела POST запроса (байт)
+MAX_BODY_BYTES = int(os.getenv('MAX_BODY_BYTES', 1_048_576))
+
+async def _bounded_body(request: Request, limit: int = MAX_BODY_BYTES) -> bytes:
+    """Чтение тела запроса потоком с ограничением размера (413 при превышении)"""
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    chunks = []
+    total = 0
+    async for chunk in request.stream():
+        total += len(chunk)
+        if total > limit:
+            raise HTTPException(status_code=413, detail="Payload too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# Тела больше порога разбираются в пуле потоков, чтобы не блокировать event loop
+JSON_OFFLOAD_THRESHOLD = int(os.getenv('JSON_OFFLOAD_THRESHOLD', 16384))
+
+# Запрос верификации подписки Notion приходит без подписи: секрет и есть этот токен
+_VERIFICATION_BODY_MAXLEN = 4096
+
+def _verification_token(body: bytes) -> Optional[str]:
+    """Токен из одноразового запроса верификации подписки ({"verification_token": ...}), иначе None"""
+    if len(body) > _VERIFICATION_BODY_MAXLEN or b'verification_token' not in body:
+        return None
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return None
+    if isinstance(data, dict) and data.keys() == {'verification_token'} and isinstance(data['verification_token'], str):
+        return data['verification_token']
+    return None
+
+def _verify_and_parse(processor: WebhookProcessor, body: bytes, signature: str) -> Dict[str, Any]:
+    """Проверка подписи и разбор JSON тела одним синхронным вызовом"""
+    if not processor.verify_signature(body, signature):
+        logger.warning("Неверная подпись webhook")
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    try:
+        event_data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        logger.error(f"Ошибка парсинга JSON: {e}")
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    # Событие Notion - всегда JSON объект; остальное в очередь не попадает
+    if not isinstance(event_data, dict):
+        logger.error(f"Тело webhook не является JSON объектом: {type(event_data).__name__}")
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    return event_data
+
+async def _handle_notion_post(request: Request):
+    """Обработка POST запросов с событиями Notion"""
+    path = request.url.path
     try:
         # Получаем тело запроса
-        body = await request.body()
+        body = await _bounded_body(request)
         
-        # Логируем сырые данные
-        logger.info(f"Получены POST данные на /notion-webhook: {body}")
+        # В INFO - только размер и отпечаток тела, само тело - в DEBUG
+        logger.info("POST %s len=%d sha1=%s", path, len(body), hashlib.sha1(body).hexdigest()[:12])
+        _dbg("Получены POST данные на %s: %s", path, body)
         
         # Получаем подпись
-        signature = request.headers.get('notion-signature', '')
+        signature = request.headers.get('x-notion-signature') or request.headers.get('notion-signature', '')
         
-        # Проверяем подпись
-        if not webhook_processor.verify_signature(body, signature):
-            logger.warning("Неверная подпись webhook")
-            raise HTTPException(status_code=401, detail="Unauthorized")
+        # Токен верификации подписки принимаем без подписи и не ставим в очередь:
+        # оператор вставляет его в Notion и в NOTION_WEBHOOK_SECRET
+        verification_token = _verification_token(body)
+        if verification_token is not None:
+            logger.warning(f"Получен токен верификации подписки Notion: {verification_token}")
+            return _EVENT_ACCEPTED_RESPONSE
         
-        # Парсим JSON
-        try:
-            event_data = json.loads(body.decode('utf-8'))
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка парсинга JSON: {e}")
-            raise HTTPException(status_code=400, detail="Invalid JSON")
+        # Проверяем подпись и парсим JSON; большие тела - в пуле потоков
+        processor = request.app.state.webhook_processor
+        if processor is None or _event_queue is None:
+            raise HTTPException(status_code=503, detail="Service not ready")
+        if len(body) > JSON_OFFLOAD_THRESHOLD:
+            event_data = await asyncio.get_running_loop().run_in_executor(
+                None, _verify_and_parse, processor, body, signature
+            )
+        else:
+            event_data = _verify_and_parse(processor, body, signature)
         
-        logger.info("Webhook событие принято на /notion-webhook")
+        logger.info(f"Webhook событие принято на {path}")
         
-        # Обрабатываем событие в фоне
-        background_tasks.add_task(webhook_processor.process_webhook_event, event_data)
+        # Ставим событие в очередь фоновой обработки
+        await _event_queue.put((body, event_data))
         
-        return {"status": "ok", "message": "Event processed"}
+        return _EVENT_ACCEPTED_RESPONSE
         
     except HTTPException:
         raise
@@ -999,19 +1320,28 @@ async def notion_webhook_post(request: Request, background_tasks: BackgroundTask
         logger.error(f"Ошибка при обработке webhook: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+app.add_api_route("/notion-webhook", _handle_notion_post, methods=["POST"])
+
+_ROOT_POST_RESPONSE = Response(
+    content=b'{"status":"ok","message":"Use /notion-webhook endpoint for webhook events"}',
+    media_type="application/json"
+)
+
 @app.post("/")
-async def webhook_root(request: Request, background_tasks: BackgroundTasks):
+async def webhook_root():
     """Обработка webhook событий на корневом URL (отключено для предотвращения дублирования)"""
-    # Отключено - используйте /notion-webhook для обработки событий
-    return {"status": "ok", "message": "Use /notion-webhook endpoint for webhook events"}
+    # Отключено - используйте /notion-webhook для обработки событий.
+    # Чтобы включить, зарегистрируйте _handle_notion_post и на этот путь
+    return _ROOT_POST_RESPONSE
 
 @app.post("/test/send")
 async def test_send(request: Request):
     """Тестовая отправка сообщения"""
     try:
-        data = await request.json()
+        data = orjson.loads(await _bounded_body(request))
         message = data.get('message', 'Test webhook with separated hierarchy')
         
+        telegram_client = request.app.state.telegram
         if telegram_client:
             success = await telegram_client.send_custom_message(message)
             if success:
@@ -1021,116 +1351,152 @@ async def test_send(request: Request):
         else:
             return {"status": "error", "message": "Telegram client not initialized"}
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при тестовой отправке: {e}")
         return {"status": "error", "message": str(e)}
 
-@app.post("/telegram/webhook")
+# Последние обработанные update_id: повторные доставки от Telegram пропускаются
+_SEEN_UPDATES_MAXLEN = 10_000
+_seen_updates: "OrderedDict[int, None]" = OrderedDict()
+
 async def telegram_webhook(request: Request):
-    """Обработка webhook обновлений от Telegram"""
+    """Обработка webhook обновлений от Telegram
+
+    Регистрируется как обычный Starlette-маршрут: тело читается вручную,
+    поэтому разбор зависимостей и валидация FastAPI здесь не нужны.
+    """
     try:
+        telegram_app = request.app.state.telegram_app
         if not telegram_app:
             logger.error("Telegram Application не инициализирован")
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=503,
                 content={"status": "error", "message": "Telegram application not initialized"}
             )
         
         # Получаем сырое тело запроса
-        body = await request.body()
+        body = await _bounded_body(request)
         logger.info(f"📥 Получен запрос от Telegram, размер: {len(body)} байт")
         
         if not body:
             logger.warning("Пустое тело запроса от Telegram")
-            return JSONResponse(content={"status": "ok"})
+            return ORJSONResponse(content={"status": "ok"})
         
         # Парсим JSON
         try:
-            data = json.loads(body.decode('utf-8'))
-        except json.JSONDecodeError as e:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
             logger.error(f"Ошибка парсинга JSON от Telegram: {e}, тело: {body[:200]}")
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=400,
                 content={"status": "error", "message": "Invalid JSON"}
             )
         
         update_id = data.get('update_id')
+        if update_id is not None:
+            if update_id in _seen_updates:
+                logger.info(f"Повторная доставка обновления {update_id} - пропускаем")
+                return ORJSONResponse(content={"status": "ok"})
+            _seen_updates[update_id] = None
+            if len(_seen_updates) > _SEEN_UPDATES_MAXLEN:
+                _seen_updates.popitem(last=False)
+        
         update_type = None
         if 'callback_query' in data:
             update_type = 'callback_query'
-            callback_query_data = data.get('callback_query', {})
-            callback_data = callback_query_data.get('data', 'N/A')
-            message_info = callback_query_data.get('message', {})
-            message_id = message_info.get('message_id', 'N/A')
-            from_user = callback_query_data.get('from', {})
-            user_info = f"{from_user.get('username', '')} ({from_user.get('id', 'N/A')})"
-            
-            logger.info(f"🔔 ===== CALLBACK_QUERY RECEIVED =====")
-            logger.info(f"🔔 Update ID: {update_id}")
-            logger.info(f"🔔 Callback data: {callback_data}")
-            logger.info(f"🔔 Message ID: {message_id}")
-            logger.info(f"🔔 От пользователя: {user_info}")
-            logger.info(f"🔔 Полные данные callback_query: {json.dumps(callback_query_data, indent=2, ensure_ascii=False)}")
-            logger.info(f"🔔 =====================================")
+            logger.info(f"📥 Получено обновление от Telegram: update_id={update_id}, тип=callback_query")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("🔔 Полные данные callback_query: %s",
+                             orjson.dumps(data['callback_query'], option=orjson.OPT_INDENT_2).decode())
         elif 'message' in data:
             update_type = 'message'
             logger.info(f"📥 Получено обновление от Telegram: update_id={update_id}, тип=message")
         else:
             logger.info(f"📥 Получено обновление от Telegram: update_id={update_id}, тип=unknown, keys={list(data.keys())}")
-            logger.info(f"📥 Полные данные: {json.dumps(data, indent=2, ensure_ascii=False)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📥 Полные данные: %s", orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
         
         # Создаем объект Update из данных
         try:
             update = Update.de_json(data, telegram_app.bot)
             if not update:
                 logger.warning(f"Не удалось создать объект Update из данных: {data}")
-                return JSONResponse(content={"status": "ok"})
+                return ORJSONResponse(content={"status": "ok"})
             
             # Проверяем тип обновления
             if update.callback_query:
-                logger.info(f"🔔 Update объект содержит callback_query: {update.callback_query.data}")
-                logger.info(f"🔔 Callback query ID: {update.callback_query.id}")
-                logger.info(f"🔔 Message: {update.callback_query.message.message_id if update.callback_query.message else 'N/A'}")
+                _dbg("🔔 Callback query ID: %s", update.callback_query.id)
             elif update.message:
-                logger.info(f"💬 Обнаружено message: {update.message.text}")
+                _dbg("💬 Обнаружено message: %s", update.message.text)
             
             # Обрабатываем обновление через Application
-            logger.info(f"🔄 Передаем обновление в Application.process_update...")
             try:
                 await telegram_app.process_update(update)
-                logger.info(f"✅ Обновление {update.update_id} успешно обработано через Application")
+                _dbg("✅ Обновление %s обработано через Application", update.update_id)
             except Exception as e:
-                logger.error(f"❌ Ошибка при обработке обновления через Application: {e}", exc_info=True)
+                logger.error(f"❌ Ошибка при обработке обновления через Application: {e}")
                 raise
             
-            return JSONResponse(content={"status": "ok"})
+            return ORJSONResponse(content={"status": "ok"})
             
         except Exception as e:
-            logger.error(f"Ошибка при обработке обновления Telegram: {e}", exc_info=True)
+            logger.error(f"Ошибка при обработке обновления Telegram: {e}")
             # Все равно возвращаем 200, чтобы Telegram не повторял запрос
-            return JSONResponse(content={"status": "ok"})
+            return ORJSONResponse(content={"status": "ok"})
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Критическая ошибка при обработке Telegram webhook: {e}", exc_info=True)
         # Возвращаем 200, чтобы Telegram не повторял запрос
-        return JSONResponse(content={"status": "ok"})
+        return ORJSONResponse(content={"status": "ok"})
+
+app.add_route("/telegram/webhook", telegram_webhook, methods=["POST"])
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Остановка при завершении"""
-    global telegram_app
-    if telegram_app:
+    state = app.state
+    # Останавливаем потребителя очереди: он обрабатывает уже принятые события и выходит
+    if _stop_event:
+        _stop_event.set()
+    if _drain_task:
+        try:
+            _event_queue.put_nowait(None)  # будим потребителя, если он ждет событий
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(_drain_task, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь событий Notion не обработана до конца при остановке")
+        except Exception as e:
+            # Ошибка потребителя не должна прерывать остальную остановку
+            logger.error(f"Ошибка обработчика очереди событий Notion при остановке: {e}")
+    
+    # Дожидаемся сообщений, уже поставленных в очередь на отправку
+    if state.webhook_processor:
+        await state.webhook_processor.wait_pending_sends()
+    
+    if state.telegram_app:
         try:
             # Удаляем webhook
             logger.info("Удаление Telegram webhook...")
-            await telegram_app.bot.delete_webhook(drop_pending_updates=False)
+            await state.telegram_app.bot.delete_webhook(drop_pending_updates=False)
             
             # Останавливаем Application
-            await telegram_app.stop()
-            await telegram_app.shutdown()
+            await state.telegram_app.stop()
+            await state.telegram_app.shutdown()
             logger.info("✅ Telegram bot остановлен")
         except Exception as e:
             logger.error(f"Ошибка при остановке Telegram bot: {e}", exc_info=True)
+    
+    if state.notion:
+        try:
+            await state.notion.aclose()
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии Notion клиента: {e}")
 
 if __name__ == "__main__":
     host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
@@ -1141,5 +1507,11 @@ if __name__ == "__main__":
         host=host,
         port=port,
         reload=False,
-        log_level="info"
+        log_level="info",
+        loop="uvloop",
+        http="httptools",
+        # Строго один процесс: Telegram webhook, очередь событий, дедупликация и кэши
+        # живут в памяти процесса - несколько воркеров регистрировали бы бота повторно
+        # и делили бы между собой обновления
+        workers=1
     )